@@ -1,18 +1,21 @@
+import re
 import pystache
-from functools import partial
+from functools import partial, lru_cache
 from numbers import Number
+from datetime import datetime
 from redash.utils import mustache_render, json_loads
 from redash.permissions import require_access, view_only
-from funcy import distinct
 from dateutil.parser import parse
 
 
-def _pluck_name_and_value(default_column, row):
-    row = {k.lower(): v for k, v in row.items()}
-    name_column = "name" if "name" in row.keys() else default_column.lower()
-    value_column = "value" if "value" in row.keys() else default_column.lower()
+def _name_and_value_columns(columns):
+    column_names = {column["name"].lower(): column["name"] for column in columns}
+    default_column = columns[0]["name"]
 
-    return {"name": row[name_column], "value": str(row[value_column])}
+    return (
+        column_names.get("name", default_column),
+        column_names.get("value", default_column),
+    )
 
 
 def _load_result(query_id, org):
@@ -31,46 +34,95 @@ def _load_result(query_id, org):
 
 def dropdown_values(query_id, org):
     data = _load_result(query_id, org)
-    first_column = data["columns"][0]["name"]
-    pluck = partial(_pluck_name_and_value, first_column)
-    return list(map(pluck, data["rows"]))
+    name_column, value_column = _name_and_value_columns(data["columns"])
+    return [
+        {"name": row[name_column], "value": str(row[value_column])}
+        for row in data["rows"]
+    ]
+
+
+def _join_parameter_list_value(value, definition):
+    multi_values_options = definition.get("multiValuesOptions", {})
+    separator = str(multi_values_options.get("separator", ","))
+    prefix = str(multi_values_options.get("prefix", ""))
+    suffix = str(multi_values_options.get("suffix", ""))
+    return separator.join([prefix + v + suffix for v in value])
 
 
 def join_parameter_list_values(parameters, schema):
+    definitions = {definition["name"]: definition for definition in reversed(schema)}
     updated_parameters = {}
     for (key, value) in parameters.items():
         if isinstance(value, list):
-            definition = next(
-                (definition for definition in schema if definition["name"] == key), {}
-            )
-            multi_values_options = definition.get("multiValuesOptions", {})
-            separator = str(multi_values_options.get("separator", ","))
-            prefix = str(multi_values_options.get("prefix", ""))
-            suffix = str(multi_values_options.get("suffix", ""))
-            updated_parameters[key] = separator.join(
-                [prefix + v + suffix for v in value]
+            updated_parameters[key] = _join_parameter_list_value(
+                value, definitions.get(key, {})
             )
         else:
             updated_parameters[key] = value
     return updated_parameters
 
 
+# Same tag grammar as pystache's parser for the default {{ }} delimiters.
+_TAG_RE = re.compile(
+    r"""
+    \{\{ \s*
+    (?:
+      (?P<change>=) \s* (?P<delims>.+?) \s* = |
+      (?P<raw>\{) \s* (?P<raw_name>.+?) \s* \} |
+      (?P<tag>[!>&/#^]?) \s* (?P<tag_key>[\s\S]+?)
+    )
+    \s* \}\}
+    """,
+    re.VERBOSE,
+)
+
+
 def _collect_key_names(nodes):
     keys = []
-    for node in nodes._parse_tree:
-        if isinstance(node, pystache.parser._EscapeNode):
-            keys.append(node.key)
-        elif isinstance(node, pystache.parser._SectionNode):
-            keys.append(node.key)
-            keys.extend(_collect_key_names(node.parsed))
+    pending = [iter(nodes._parse_tree)]
+    while pending:
+        for node in pending[-1]:
+            if isinstance(node, pystache.parser._EscapeNode):
+                keys.append(node.key)
+            elif isinstance(node, pystache.parser._SectionNode):
+                keys.append(node.key)
+                pending.append(iter(node.parsed._parse_tree))
+                break
+        else:
+            pending.pop()
+
+    return list(dict.fromkeys(keys))
 
-    return distinct(keys)
 
+@lru_cache(maxsize=1024)
+def _parse_template(template):
+    return pystache.parse(template)
 
+
+@lru_cache(maxsize=4096)
 def _collect_query_parameters(query):
-    nodes = pystache.parse(query)
-    keys = _collect_key_names(nodes)
-    return keys
+    keys = []
+    sections = []
+    for match in _TAG_RE.finditer(query):
+        if match.group("change"):
+            break
+
+        tag, key = match.group("tag"), match.group("tag_key")
+        if tag == "/":
+            if not sections or sections.pop()[1] != key:
+                break
+            continue
+        if tag in ("#", "^"):
+            sections.append((tag, key))
+        # keys inside inverted sections are never collected
+        if tag in ("", "#") and not any(t == "^" for (t, _) in sections):
+            keys.append(key)
+    else:
+        if not sections:
+            return tuple(dict.fromkeys(keys))
+
+    # custom delimiters and unbalanced sections need the full parser
+    return tuple(_collect_key_names(_parse_template(query)))
 
 
 def _parameter_names(parameter_values):
@@ -96,7 +148,29 @@ def _is_number(string):
             return False
 
 
+# fromisoformat accepts more than dateutil does (week dates, any date/time
+# separator, compact times, offsets with seconds), so only the plain shape
+# takes the fast path
+_ISO_DATE_RE = re.compile(
+    r"[0-9]{4}-[0-9]{2}-[0-9]{2}"
+    r"(?:[ T][0-9]{2}:[0-9]{2}(?::[0-9]{2}(?:\.[0-9]{1,6})?)?)?"
+)
+
+
+def _is_iso_date(string):
+    if not _ISO_DATE_RE.fullmatch(string):
+        return False
+    try:
+        datetime.fromisoformat(string)
+        return True
+    except ValueError:
+        return False
+
+
 def _is_date(string):
+    if isinstance(string, str) and _is_iso_date(string):
+        return True
+
     try:
         parse(string)
         return True
@@ -113,83 +187,141 @@ def _is_date_range(obj):
 
 def _is_value_within_options(value, dropdown_options, allow_list=False):
     if isinstance(value, list):
-        return allow_list and set(map(str, value)).issubset(set(dropdown_options))
+        return allow_list and dropdown_options.issuperset(map(str, value))
     return str(value) in dropdown_options
 
 
+def _allows_multiple_values(definition):
+    return isinstance(definition.get("multiValuesOptions"), dict)
+
+
+def _enum_options(definition):
+    enum_options = definition.get("enumOptions")
+    if isinstance(enum_options, str):
+        enum_options = enum_options.split("\n")
+
+    return frozenset(enum_options or [])
+
+
+def _is_unsupported_value(value):
+    return False
+
+
+_VALIDATORS = {
+    "text": lambda value: isinstance(value, str),
+    "number": _is_number,
+    "date": _is_date,
+    "datetime-local": _is_date,
+    "datetime-with-seconds": _is_date,
+    "date-range": _is_date_range,
+    "datetime-range": _is_date_range,
+    "datetime-range-with-seconds": _is_date_range,
+}
+
+
 class ParameterizedQuery(object):
     def __init__(self, template, schema=None, org=None):
         self.schema = schema or []
+        # first definition wins for duplicated names
+        self._schema_by_name = {
+            definition["name"]: definition for definition in reversed(self.schema)
+        }
         self.org = org
         self.template = template
         self.query = template
         self.parameters = {}
+        self._dropdown_cache = {}
+        self._enum_option_sets = {}
+        self._validators = None
 
     def apply(self, parameters):
-        invalid_parameter_names = [
-            key for (key, value) in parameters.items() if not self._valid(key, value)
-        ]
-        if invalid_parameter_names:
-            raise InvalidParameterError(invalid_parameter_names)
+        if self.schema:
+            query_parameters = self._validated_query_parameters(parameters)
         else:
-            self.parameters.update(parameters)
-            self.query = mustache_render(
-                self.template, join_parameter_list_values(parameters, self.schema)
-            )
+            query_parameters = join_parameter_list_values(parameters, self.schema)
+
+        self.parameters.update(parameters)
+        self.query = mustache_render(_parse_template(self.template), query_parameters)
 
         return self
 
-    def _valid(self, name, value):
-        if not self.schema:
-            return True
+    def _validated_query_parameters(self, parameters):
+        if self._validators is None:
+            self._validators = self._bind_validators()
+        self._dropdown_cache = {}
+        invalid_parameter_names = []
+        query_parameters = {}
+        for (key, value) in parameters.items():
+            if not self._valid(key, value):
+                invalid_parameter_names.append(key)
+            elif isinstance(value, list):
+                query_parameters[key] = _join_parameter_list_value(
+                    value, self._schema_by_name.get(key, {})
+                )
+            else:
+                query_parameters[key] = value
 
-        definition = next(
-            (definition for definition in self.schema if definition["name"] == name),
-            None,
-        )
+        if invalid_parameter_names:
+            raise InvalidParameterError(invalid_parameter_names)
 
-        if not definition:
-            return False
+        return query_parameters
 
-        enum_options = definition.get("enumOptions")
-        query_id = definition.get("queryId")
-        allow_multiple_values = isinstance(definition.get("multiValuesOptions"), dict)
-
-        if isinstance(enum_options, str):
-            enum_options = enum_options.split("\n")
-
-        validators = {
-            "text": lambda value: isinstance(value, str),
-            "number": _is_number,
-            "enum": lambda value: _is_value_within_options(
-                value, enum_options, allow_multiple_values
-            ),
-            "query": lambda value: _is_value_within_options(
-                value,
-                [v["value"] for v in dropdown_values(query_id, self.org)],
-                allow_multiple_values,
-            ),
-            "date": _is_date,
-            "datetime-local": _is_date,
-            "datetime-with-seconds": _is_date,
-            "date-range": _is_date_range,
-            "datetime-range": _is_date_range,
-            "datetime-range-with-seconds": _is_date_range,
+    def _bind_validators(self):
+        options_validators = {
+            "enum": self._is_valid_enum_value,
+            "query": self._is_valid_query_value,
         }
+        validators = {}
+        for (name, definition) in self._schema_by_name.items():
+            parameter_type = definition["type"]
+            if parameter_type in options_validators:
+                validate = partial(options_validators[parameter_type], definition)
+            else:
+                validate = _VALIDATORS.get(parameter_type, _is_unsupported_value)
+            validators[name] = validate
+
+        return validators
 
-        validate = validators.get(definition["type"], lambda x: False)
+    def _valid(self, name, value):
+        validate = self._validators.get(name)
+
+        if not validate:
+            return False
 
         return validate(value)
 
+    def _is_valid_enum_value(self, definition, value):
+        name = definition["name"]
+        if name not in self._enum_option_sets:
+            self._enum_option_sets[name] = _enum_options(definition)
+
+        return _is_value_within_options(
+            value, self._enum_option_sets[name], _allows_multiple_values(definition)
+        )
+
+    def _is_valid_query_value(self, definition, value):
+        return _is_value_within_options(
+            value,
+            self._dropdown_options(definition.get("queryId")),
+            _allows_multiple_values(definition),
+        )
+
+    def _dropdown_options(self, query_id):
+        if query_id not in self._dropdown_cache:
+            self._dropdown_cache[query_id] = frozenset(
+                v["value"] for v in dropdown_values(query_id, self.org)
+            )
+
+        return self._dropdown_cache[query_id]
+
     @property
     def is_safe(self):
-        text_parameters = [param for param in self.schema if param["type"] == "text"]
-        return not any(text_parameters)
+        return not any(param["type"] == "text" for param in self.schema)
 
     @property
     def missing_params(self):
         query_parameters = set(_collect_query_parameters(self.template))
-        return set(query_parameters) - set(_parameter_names(self.parameters))
+        return query_parameters - set(_parameter_names(self.parameters))
 
     @property
     def text(self):
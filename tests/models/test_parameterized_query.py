@@ -38,6 +38,28 @@ class TestParameterizedQuery(TestCase):
         ).apply({"param": "value", "table": "value"})
         self.assertEqual(set(["test", "nested_param"]), query.missing_params)
 
+    def test_ignores_comments_and_literal_tags(self):
+        query = ParameterizedQuery("SELECT {{param}} {{! comment }} {{&literal}}")
+        self.assertEqual(set(["param"]), query.missing_params)
+
+    def test_ignores_params_in_inverted_sections(self):
+        query = ParameterizedQuery(
+            "SELECT 1 {{^flag}} WHERE x={{d}}{{/flag}} -- {{param}}"
+        )
+        self.assertEqual(set(["param"]), query.missing_params)
+
+    def test_ignores_sections_nested_in_inverted_sections(self):
+        query = ParameterizedQuery("{{#a}}{{^b}}{{#c}}{{d}}{{/c}}{{/b}}{{e}}{{/a}}")
+        self.assertEqual(set(["a", "e"]), query.missing_params)
+
+    def test_handles_unclosed_sections_like_pystache(self):
+        query = ParameterizedQuery("SELECT {{a}} {{#s}} {{b}}")
+        self.assertEqual(set(["b"]), query.missing_params)
+
+    def test_handles_custom_delimiters(self):
+        query = ParameterizedQuery("{{=<% %>=}} SELECT <%param%> FROM <%table%>")
+        self.assertEqual(set(["param", "table"]), query.missing_params)
+
     def test_handles_objects(self):
         query = ParameterizedQuery(
             "SELECT * FROM USERS WHERE created_at between '{{ created_at.start }}' and '{{ created_at.end }}'"
@@ -111,6 +133,29 @@ class TestParameterizedQuery(TestCase):
 
         self.assertEqual("foo 2000-01-01 12:00:00", query.text)
 
+    def test_validates_iso_date_parameters(self):
+        schema = [{"name": "bar", "type": "date"}, {"name": "baz", "type": "date"}]
+        query = ParameterizedQuery("foo {{bar}} {{baz}}", schema)
+
+        query.apply({"bar": "2000-01-01", "baz": "2000-01-01T12:00:00"})
+
+        self.assertEqual("foo 2000-01-01 2000-01-01T12:00:00", query.text)
+
+    def test_raises_on_iso_week_date_parameters(self):
+        schema = [{"name": "bar", "type": "date"}]
+        query = ParameterizedQuery("foo", schema)
+
+        with pytest.raises(InvalidParameterError):
+            query.apply({"bar": "2000-W01-1"})
+
+    def test_raises_on_non_standard_iso_date_parameters(self):
+        schema = [{"name": "bar", "type": "date"}]
+        query = ParameterizedQuery("foo", schema)
+
+        for value in ["2034-07-08 12.17", "2080-09-08T14431569", "2033-03-18T007Z"]:
+            with pytest.raises(InvalidParameterError):
+                query.apply({"bar": value})
+
     def test_raises_on_invalid_enum_parameters(self):
         schema = [{"name": "bar", "type": "enum", "enumOptions": ["baz", "qux"]}]
         query = ParameterizedQuery("foo", schema)
@@ -162,6 +207,17 @@ class TestParameterizedQuery(TestCase):
 
         self.assertEqual("foo 'qux','baz'", query.text)
 
+    def test_uses_first_definition_for_duplicated_names(self):
+        schema = [
+            {"name": "bar", "type": "enum", "enumOptions": ["baz"]},
+            {"name": "bar", "type": "number"},
+        ]
+        query = ParameterizedQuery("foo {{bar}}", schema)
+
+        query.apply({"bar": "baz"})
+
+        self.assertEqual("foo baz", query.text)
+
     @patch(
         "redash.models.parameterized_query.dropdown_values",
         return_value=[{"value": "1"}],
@@ -205,6 +261,22 @@ class TestParameterizedQuery(TestCase):
 
         self.assertEqual("foo baz", query.text)
 
+    @patch(
+        "redash.models.parameterized_query.dropdown_values",
+        return_value=[{"value": "baz"}, {"value": "qux"}],
+    )
+    def test_loads_shared_dropdown_query_once_per_apply(self, dropdown_values):
+        schema = [
+            {"name": "bar", "type": "query", "queryId": 1},
+            {"name": "baz", "type": "query", "queryId": 1},
+        ]
+        query = ParameterizedQuery("foo {{bar}} {{baz}}", schema)
+
+        query.apply({"bar": "baz", "baz": "qux"})
+
+        self.assertEqual("foo baz qux", query.text)
+        dropdown_values.assert_called_once_with(1, None)
+
     def test_raises_on_invalid_date_range_parameters(self):
         schema = [{"name": "bar", "type": "date-range"}]
         query = ParameterizedQuery("foo", schema)